@@ -1,10 +1,19 @@
+import hashlib
 import math
 import random
 from abc import ABC, abstractclassmethod, abstractmethod, abstractproperty
-from dataclasses import dataclass
-from typing import Dict, List, Tuple
-
-from lark import Lark, Transformer, Tree, Visitor
+from dataclasses import dataclass, field
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Sequence,
+    Tuple,
+)
+
+from lark import Lark, Transformer_NonRecursive, Tree, Visitor
 from lark.grammar import NonTerminal, Terminal
 from lark.tree_matcher import TreeMatcher
 
@@ -41,9 +50,16 @@ class Grammar(object):
         )
 
         self._tree_matcher = TreeMatcher(self._lark_parser)
+        # The LALR tables lark built for `start`, behind its internal wrappers.
+        self._parse_table = self._lark_parser.parser.parser.parser.parse_table
+        self._child_rule_names = {}
 
         self._initialize_sampler_constants()
 
+        self._derivation_counts = {}
+        self._derivation_sizes = {}
+        self._production_suffix_counts = {}
+
         self._lark_parser_for_start = {
             k.value: Lark(
                 grammar_spec,
@@ -89,6 +105,17 @@ class Grammar(object):
         ):
             allowed_rules = {*terminal_map, *nonterminals}
 
+        # Tree names of aliased productions mapped to their rule, when unique.
+        alias_origins = {}
+        for rule in rules:
+            if rule.alias:
+                alias_origins.setdefault(rule.alias, set()).add(rule.origin.name)
+        self._alias_origins = {
+            alias: origin
+            for alias, (origin, *others) in alias_origins.items()
+            if not others
+        }
+
         self._terminal_map = terminal_map
         self._rev_terminal_map = {v: k for k, v in terminal_map.items()}
         self._nonterminals = nonterminals
@@ -96,34 +123,54 @@ class Grammar(object):
 
         self._vocabulary = sorted(list(set(terminal_map.values())))
 
-        def _compute_min_primitives(x, path=None):
-            if path is None:
-                path = []
-            path_lookup = set(path)
-
-            if x.name in path_lookup:
-                return float("inf")
-
-            if x.name in self._primitives:
-                return 1
-
-            if isinstance(x, Terminal):
-                return 0
-
-            productions = self._nonterminals.get(x.name, [])
-            new_path = path + [x.name]
+        # Production ids number every (nonterminal, expansion) pair in
+        # nonterminal order, for the array encoding used by lang_tools.Derivation.
+        rules_by_production = {(r.origin.name, tuple(r.expansion)): r for r in rules}
+        self._productions = []
+        self._production_ids = {}
+        self._production_rules = []
+        for name, productions in nonterminals.items():
+            for p in productions:
+                self._production_ids[(name, p)] = len(self._productions)
+                self._productions.append((names_to_symbols[name], p))
+                self._production_rules.append(rules_by_production[(name, p)])
+
+        self._production_arity = [
+            sum(isinstance(x, NonTerminal) for x in p) for _, p in self._productions
+        ]
+
+        def _compute_min_primitives():
+            # Least fixed point of min over productions, relaxed until stable.
+            # Every pass finalizes at least one more nonterminal.
+            rv = {}
+            for name in nonterminals:
+                rv[name] = 1 if name in self._primitives else float("inf")
+
+            def _symbol_min_primitives(x):
+                if x.name in self._primitives:
+                    return 1
+                if isinstance(x, Terminal):
+                    return 0
+                return rv.get(x.name, float("inf"))
+
+            changed = True
+            while changed:
+                changed = False
+                for name, productions in nonterminals.items():
+                    if name in self._primitives:
+                        continue
+                    value = min(
+                        (
+                            sum(_symbol_min_primitives(x) for x in p)
+                            for p in productions
+                        ),
+                        default=float("inf"),
+                    )
+                    if value < rv[name]:
+                        rv[name] = value
+                        changed = True
 
-            sub_min_primitives = [
-                sum(_compute_min_primitives(x_, new_path) for x_ in p)
-                for p in productions
-            ]
-
-            rv = min(
-                sub_min_primitives,
-                default=float("inf"),
-            )
-
-            return rv
+            return _symbol_min_primitives
 
         all_terminals_and_nonterminals = set()
         for k, v in nonterminals.items():
@@ -131,9 +178,10 @@ class Grammar(object):
                 for s in p:
                     all_terminals_and_nonterminals.add(s)
 
+        symbol_min_primitives = _compute_min_primitives()
         self._min_primitives = {}
         for x in all_terminals_and_nonterminals:
-            self._min_primitives[x] = _compute_min_primitives(x)
+            self._min_primitives[x] = symbol_min_primitives(x)
 
         self._min_primitives_choices = {}
         for x in all_terminals_and_nonterminals:
@@ -147,6 +195,95 @@ class Grammar(object):
 
         self._start_symbol = self._names_to_symbols[self._start_name]
 
+    def _extend_derivation_counts(self, max_primitives: int):
+        counts = self._derivation_counts
+        suffixes = self._production_suffix_counts
+
+        sizes = self._derivation_sizes
+
+        if not counts:
+            for name, productions in self._nonterminals.items():
+                counts[self._names_to_symbols[name]] = []
+                sizes[self._names_to_symbols[name]] = []
+                for index, production in enumerate(productions):
+                    suffixes[(name, index)] = [[] for _ in range(len(production) + 1)]
+
+        # counts[X][k] is the number of derivations of X with exactly k
+        # primitives and sizes[X] lists the k for which it is nonzero.
+        # suffixes[(X, p)][i][k] is the same for the symbols of production p of
+        # X from position i onwards.
+        for k in range(len(counts[self._start_symbol]), max_primitives + 1):
+            for table in counts.values():
+                table.append(0)
+            for tables in suffixes.values():
+                for table in tables[:-1]:
+                    table.append(0)
+                tables[-1].append(int(k == 0))
+
+            # Splits giving a symbol 1..k-1 primitives only involve smaller
+            # sizes, so their part of each convolution is computed once.
+            inner = {}
+            for (name, index), tables in suffixes.items():
+                production = self._nonterminals[name][index]
+                for i, symbol in enumerate(production):
+                    if isinstance(symbol, NonTerminal):
+                        symbol_counts = counts[symbol]
+                        inner[(name, index, i)] = sum(
+                            symbol_counts[j] * tables[i + 1][k - j]
+                            for j in sizes[symbol]
+                            if 0 < j < k
+                        )
+
+            # The remaining splits, all primitives to the symbol or none, can
+            # make entries at size k depend on each other through symbols
+            # without primitives, so iterate them to a fixed point. Without a
+            # cycle this takes at most one pass per nonterminal.
+            for _ in range(len(counts) + 1):
+                for (name, index), tables in suffixes.items():
+                    production = self._nonterminals[name][index]
+                    for i in reversed(range(len(production))):
+                        symbol = production[i]
+                        if isinstance(symbol, Terminal):
+                            tables[i][k] = tables[i + 1][k]
+                            continue
+                        symbol_counts = counts[symbol]
+                        value = inner[(name, index, i)]
+                        value += symbol_counts[0] * tables[i + 1][k]
+                        if k > 0:
+                            value += symbol_counts[k] * tables[i + 1][0]
+                        tables[i][k] = value
+
+                changed = False
+                for symbol, table in counts.items():
+                    remaining = k - int(symbol.name in self._primitives)
+                    value = 0
+                    if remaining >= 0:
+                        value = sum(
+                            suffixes[(symbol.name, index)][0][remaining]
+                            for index in range(len(self._nonterminals[symbol.name]))
+                        )
+                    if value != table[k]:
+                        table[k] = value
+                        changed = True
+
+                if not changed:
+                    break
+            else:
+                raise ValueError(f"Infinitely many derivations with {k} primitives")
+
+            for symbol, table in counts.items():
+                if table[k]:
+                    sizes[symbol].append(k)
+
+    def derivation_counts(self, symbol, max_primitives: int) -> List[int]:
+        """Number of derivations of `symbol` with exactly 0..max_primitives primitives."""
+
+        if isinstance(symbol, Terminal):
+            return [int(k == 0) for k in range(max_primitives + 1)]
+
+        self._extend_derivation_counts(max_primitives)
+        return self._derivation_counts[symbol][: max_primitives + 1]
+
     @property
     def vocabulary(self):
         return self._vocabulary
@@ -162,6 +299,44 @@ class Grammar(object):
     def parse(self, expression: str):
         return self.lark_parser.parse(expression)
 
+    def child_rule_name(self, tree: Tree) -> str:
+        """Name of the rule `tree` was derived from in its parent's production.
+
+        `tree` needs the `parent` and `parent_index` attributes set by AddParents.
+        """
+
+        # Match a copy of the parent with childless children, cached by shape
+        # with aliases folded into their rule: the matcher only looks at child
+        # names, and lark hashes and compares whole subtrees recursively.
+        parent = tree.parent
+        shape = (
+            parent.data,
+            tuple(
+                (
+                    self._alias_origins.get(c.data, c.data)
+                    if isinstance(c, Tree)
+                    else c.type
+                )
+                for c in parent.children
+            ),
+        )
+
+        rule_names = self._child_rule_names.get(shape)
+        if rule_names is None:
+            shallow = Tree(
+                parent.data,
+                [
+                    Tree(c.data, []) if isinstance(c, Tree) else c
+                    for c in parent.children
+                ],
+            )
+            matched = self.tree_matcher.match_tree(shallow, parent.data)
+            rule_names = self._child_rule_names[shape] = [
+                c.data if isinstance(c, Tree) else None for c in matched.children
+            ]
+
+        return rule_names[tree.parent_index]
+
     @property
     def lark_parser(self):
         return self._lark_parser
@@ -170,6 +345,10 @@ class Grammar(object):
     def tree_matcher(self):
         return self._tree_matcher
 
+    @property
+    def parse_table(self):
+        return self._parse_table
+
     @property
     def start_symbol(self):
         return self._start_symbol
@@ -186,6 +365,22 @@ class Grammar(object):
     def nonterminals(self):
         return self._nonterminals
 
+    @property
+    def productions(self):
+        return self._productions
+
+    @property
+    def production_ids(self):
+        return self._production_ids
+
+    @property
+    def production_rules(self):
+        return self._production_rules
+
+    @property
+    def production_arity(self):
+        return self._production_arity
+
 
 class Environment(ABC):
     @abstractproperty
@@ -242,7 +437,7 @@ _SCALE_X = _CANVAS_WIDTH / 32
 _SCALE_Y = _CANVAS_HEIGHT / 32
 
 
-class CSG2DAtoPath(Transformer):
+class CSG2DAtoPath(Transformer_NonRecursive):
     def __init__(
         self,
         visit_tokens: bool = True,
@@ -300,23 +495,10 @@ class CSG2DAtoPath(Transformer):
         return f"circle {r} {x} {y}"
 
     def binop(self, children):
+        # Flattened once by CSG2DACompiler, concatenating lists here would be
+        # quadratic in the depth of the expression.
         op, left, right = children
-
-        res = []
-
-        if isinstance(left, list):
-            res.extend(left)
-        else:
-            res.append(left)
-
-        res.append(op)
-
-        if isinstance(right, list):
-            res.extend(right)
-        else:
-            res.append(right)
-
-        return res
+        return (left, op, right)
 
     def add(self, children):
         return "+"
@@ -400,6 +582,91 @@ class CSG2DAtoPath(Transformer):
         return 315
 
 
+_NUMBER_SYMBOLS = "0123456789ABCDEF"
+_ANGLE_SYMBOLS = "GHIJKLMN"
+
+
+class CSG2DACanonicalizer(CSG2DAtoPath):
+    """Rewrites a CSG2DA tree into a canonical expression string.
+
+    Expressions are drawn by applying their flattened paths and ops left to
+    right, so the operands of a `+` are only ordered when both are unions of
+    primitives and the `+` is entered with a union. Unions are ordered by a
+    hash of their canonical form rather than the string itself, so no subtree
+    string is built before the final walk.
+    Quads are normalized to an angle of 0 or 45 degrees: a rectangle is
+    symmetric under a 180 degree rotation, and a 90 degree rotation is the same
+    as swapping its width and height. Primitive counts are preserved.
+    """
+
+    def quad(self, children):
+        x, y, w, h, angle_degrees = children
+
+        angle_index = (angle_degrees // 45) % 4
+        if angle_index >= 2:
+            w, h = h, w
+            angle_index -= 2
+
+        numbers = " ".join(_NUMBER_SYMBOLS[v] for v in (x, y, w, h))
+        return f"(Quad {numbers} {_ANGLE_SYMBOLS[angle_index]})"
+
+    def circle(self, children):
+        numbers = " ".join(_NUMBER_SYMBOLS[v] for v in children)
+        return f"(Circle {numbers})"
+
+    @staticmethod
+    def _union_key(node):
+        # Hash of the canonical form of a union of primitives, None otherwise.
+        if isinstance(node, str):
+            return hashlib.blake2b(node.encode(), digest_size=16).digest()
+        return node[3]
+
+    def binop(self, children):
+        op, left, right = children
+
+        # Nodes are (op, left, right, union key, swap operands) and the key is
+        # only set for unions of primitives, which are only reordered when
+        # entered by a union.
+        key, swap = None, False
+        if op == "+":
+            left_key, right_key = self._union_key(left), self._union_key(right)
+            if left_key is not None and right_key is not None:
+                swap = right_key < left_key
+                low, high = sorted([left_key, right_key])
+                key = hashlib.blake2b(b"+" + low + high, digest_size=16).digest()
+
+        return (op, left, right, key, swap)
+
+    def canonicalize(self, expression: Tree) -> str:
+        rv = []
+        # Items are strings to emit or (node, entered by a union) pairs. The
+        # first path of an expression is always added to the empty canvas.
+        stack = [(self.transform(expression), True)]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                rv.append(item)
+                continue
+
+            node, entered_by_union = item
+            if isinstance(node, str):
+                rv.append(node)
+                continue
+
+            op, left, right, key, swap = node
+            if entered_by_union and key is not None:
+                if swap:
+                    left, right = right, left
+                stack.extend([")", (right, True), " ", (left, True), "(+ "])
+                continue
+
+            stack.extend(
+                [")", (right, op == "+"), " ", (left, entered_by_union), f"({op} "]
+            )
+
+        return "".join(rv)
+
+
 class CSG2DACompiler(Compiler):
     def __init__(self) -> None:
         super().__init__()
@@ -407,7 +674,18 @@ class CSG2DACompiler(Compiler):
 
     def _get_path(self, expression: Tree):
         paths_and_ops = self._expression_to_path.transform(expression)
-        return paths_and_ops
+        if isinstance(paths_and_ops, str):
+            return paths_and_ops
+
+        rv = []
+        stack = [paths_and_ops]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, tuple):
+                stack.extend(reversed(item))
+            else:
+                rv.append(item)
+        return rv
 
     def compile(self, expression: Tree):
         return self._get_path(expression)
@@ -424,6 +702,7 @@ class CSG2DA(Environment):
         )
 
         self._compiler = CSG2DACompiler()
+        self._canonicalizer = CSG2DACanonicalizer()
         # self._observation_compiler = CSG2DASketchCompiler()
         # self._goal_checker = BinaryIOUGoalChecker()
 
@@ -450,6 +729,9 @@ class CSG2DA(Environment):
     def goal_reached(self, compiledA, compiledB) -> bool:
         return self._goal_checker.goal_reached(compiledA, compiledB)
 
+    def canonicalize(self, expression: str) -> str:
+        return self._canonicalizer.canonicalize(self.grammar.parse(expression))
+
 
 class GrammarSampler(ABC):
     def __init__(self, grammar: Grammar):
@@ -466,18 +748,145 @@ class GrammarSampler(ABC):
 
 class NaiveRandomSampler(GrammarSampler):
     def sample(self, start) -> str:
-        def _sample_inner(current):
+        rv = []
+        stack = [start]
+        while stack:
+            current = stack.pop()
+
             if isinstance(current, Terminal):
-                return self.grammar._terminal_map[current.name]
+                rv.append(self.grammar._terminal_map[current.name])
+                continue
 
             choices = self.grammar._nonterminals[current.name]
             weights = self.grammar._sampling_weights.get(current.name)
 
             choice = random.choices(choices, weights=weights)[0]
+            stack.extend(reversed(choice))
+
+        return "".join(rv)
+
+
+def _weighted_index(weights: List[int]) -> int:
+    # Exact for arbitrarily large integer weights, unlike random.choices.
+    r = random.randrange(sum(weights))
+    for index, weight in enumerate(weights):
+        if r < weight:
+            return index
+        r -= weight
+
+
+def _boustrophedon(k: int) -> Iterator[int]:
+    # 0, k, 1, k - 1, ... reaches split j after O(min(j, k - j)) steps.
+    low, high = 0, k
+    while low < high:
+        yield low
+        yield high
+        low += 1
+        high -= 1
+    if low == high:
+        yield low
+
+
+class UniformSizeSampler(GrammarSampler):
+    """Samples uniformly among all derivations with a given number of primitives.
+
+    Expansion is guided by the exact derivation counts cached on the grammar,
+    so every draw succeeds without rejection. Splits of the remaining
+    primitives are tried from both ends, which bounds a draw of n primitives
+    by O(n log n) big-integer multiplications, and O(n) for typical splits.
+    """
+
+    def sample(
+        self,
+        start,
+        min_primitives=4,
+        max_primitives=10,
+        return_productions=False,
+    ):
+        assert (
+            min_primitives <= max_primitives
+        ), "min_primitives must be <= max_primitives"
+
+        counts = self.grammar.derivation_counts(start, max_primitives)
+        sizes = [k for k in range(min_primitives, max_primitives + 1) if counts[k]]
+        if not sizes:
+            raise ValueError(
+                f"{start} has no derivations with {min_primitives} to "
+                f"{max_primitives} primitives"
+            )
+
+        return self.sample_with_primitives(
+            start, random.choice(sizes), return_productions=return_productions
+        )
+
+    def sample_with_primitives(
+        self,
+        start,
+        num_primitives: int,
+        return_productions=False,
+    ):
+        grammar = self.grammar
+        if not grammar.derivation_counts(start, num_primitives)[num_primitives]:
+            raise ValueError(
+                f"{start} has no derivations with {num_primitives} primitives"
+            )
+
+        # Per nonterminal: whether it is a primitive, its productions, their
+        # suffix count tables and their production ids.
+        options = {}
+        for name, choices in grammar._nonterminals.items():
+            options[name] = (
+                name in grammar._primitives,
+                choices,
+                [
+                    grammar._production_suffix_counts[(name, index)]
+                    for index in range(len(choices))
+                ],
+                [grammar.production_ids[(name, choice)] for choice in choices],
+            )
+
+        rv = []
+        productions = []
+        stack = [(start, num_primitives)]
+        while stack:
+            symbol, k = stack.pop()
+
+            if isinstance(symbol, Terminal):
+                rv.append(grammar._terminal_map[symbol.name])
+                continue
+
+            is_primitive, choices, suffixes, production_ids = options[symbol.name]
+            k -= int(is_primitive)
+            index = _weighted_index([tables[0][k] for tables in suffixes])
+            production = choices[index]
+            tables = suffixes[index]
+            productions.append(production_ids[index])
+
+            children = []
+            for i, child in enumerate(production):
+                if isinstance(child, Terminal):
+                    children.append((child, 0))
+                    continue
+
+                child_counts = grammar._derivation_counts[child]
+                r = random.randrange(tables[i][k])
+                for child_primitives in _boustrophedon(k):
+                    weight = (
+                        child_counts[child_primitives]
+                        * tables[i + 1][k - child_primitives]
+                    )
+                    if r < weight:
+                        break
+                    r -= weight
+                children.append((child, child_primitives))
+                k -= child_primitives
 
-            return "".join(self.sample(x) for x in choice)
+            stack.extend(reversed(children))
 
-        return _sample_inner(start)
+        if return_productions:
+            return productions
+
+        return "".join(rv)
 
 
 @dataclass
@@ -506,6 +915,7 @@ class ConstrainedRandomSampler(GrammarSampler):
         min_primitives=4,
         max_primitives=10,
         return_steps=False,
+        return_productions=False,
     ):
         num_primitives = random.randint(min_primitives, max_primitives)
         min_primitives = num_primitives
@@ -518,39 +928,39 @@ class ConstrainedRandomSampler(GrammarSampler):
         tree = Tree(start, [])
         choice_history = []
 
-        def tree_to_string(tree: Tree) -> str:
-            if not tree.children:
-                if isinstance(tree.data, Terminal):
-                    return self.grammar._terminal_map[tree.data.name]
-                return ""
-            return "".join(tree_to_string(child) for child in tree.children)
+        def iter_nodes(tree: Tree):
+            stack = [tree]
+            while stack:
+                node = stack.pop()
+                yield node
+                stack.extend(reversed(node.children))
 
-        def tree_to_string_node_position(tree: Tree, search_node: Tree):
-            def _f(tree: Tree, search_node: Tree, current_start=0) -> tuple[str, int]:
-                found = -1
-
-                if tree is search_node:
-                    found = current_start
+        def iter_leaves(tree: Tree):
+            return (node for node in iter_nodes(tree) if not node.children)
 
-                if not tree.children:
-                    if isinstance(tree.data, Terminal):
-                        return self.grammar._terminal_map[tree.data.name], found
-                    return f"<{tree.data.name}>", found
-
-                current = current_start
-                current_rv = ""
-                for child in tree.children:
-                    stringified, c_found = _f(child, search_node, current)
-                    if c_found != -1:
-                        found = c_found
-                    current_rv += stringified
-                    current += len(stringified)
+        def tree_to_string(tree: Tree) -> str:
+            return "".join(
+                self.grammar._terminal_map[leaf.data.name]
+                for leaf in iter_leaves(tree)
+                if isinstance(leaf.data, Terminal)
+            )
 
-                return current_rv, found
+        def tree_to_string_node_position(tree: Tree, search_node: Tree):
+            parts = []
+            current = 0
+            start = -1
+            for leaf in iter_leaves(tree):
+                if leaf is search_node:
+                    start = current
+                if isinstance(leaf.data, Terminal):
+                    stringified = self.grammar._terminal_map[leaf.data.name]
+                else:
+                    stringified = f"<{leaf.data.name}>"
+                parts.append(stringified)
+                current += len(stringified)
 
-            rv, start = _f(tree, search_node)
             end = start + len(f"<{search_node.data.name}>")
-            return rv, start, end
+            return "".join(parts), start, end
 
         def pick_expansion(nt, choose_fn=None):
             if return_steps:
@@ -586,20 +996,18 @@ class ConstrainedRandomSampler(GrammarSampler):
             return chosen
 
         def num_primitives_in_tree(tree):
-            return sum(num_primitives_in_tree(child) for child in tree.children) + int(
-                tree.data.name in self.grammar._primitives
-            )
+            rv = 0
+            stack = [tree]
+            while stack:
+                node = stack.pop()
+                rv += int(node.data.name in self.grammar._primitives)
+                stack.extend(node.children)
+            return rv
 
         def get_unexpanded(tree):
-            if not len(tree.children):
-                if isinstance(tree.data, NonTerminal):
-                    return [tree]
-                return []
-
-            rv = []
-            for child in tree.children:
-                rv.extend(get_unexpanded(child))
-            return rv
+            return [
+                leaf for leaf in iter_leaves(tree) if isinstance(leaf.data, NonTerminal)
+            ]
 
         current_primitives = 0
         unexpanded_min_primitives = self.grammar._min_primitives[start]
@@ -615,7 +1023,11 @@ class ConstrainedRandomSampler(GrammarSampler):
             else:
                 choice_fn = min
 
-            current_unexpanded = random.choice(queue)
+            # Swap-remove keeps taking a node out of the frontier O(1).
+            current_index = random.randrange(len(queue))
+            current_unexpanded = queue[current_index]
+            queue[current_index] = queue[-1]
+            queue.pop()
 
             expansion = pick_expansion(current_unexpanded, choice_fn)
             current_primitives += sum(
@@ -628,7 +1040,6 @@ class ConstrainedRandomSampler(GrammarSampler):
                 self.grammar._min_primitives[item] for item in expansion
             )
             current_unexpanded.children = [Tree(item, []) for item in expansion]
-            queue.remove(current_unexpanded)
             queue.extend(
                 [
                     child
@@ -637,7 +1048,16 @@ class ConstrainedRandomSampler(GrammarSampler):
                 ]
             )
 
-        expression = tree_to_string(tree)
+        if return_productions:
+            expression = [
+                self.grammar.production_ids[
+                    (node.data.name, tuple(child.data for child in node.children))
+                ]
+                for node in iter_nodes(tree)
+                if isinstance(node.data, NonTerminal)
+            ]
+        else:
+            expression = tree_to_string(tree)
 
         if return_steps:
             return expression, choice_history
@@ -650,7 +1070,8 @@ class Mutation(object):
     start: int
     end: int
     replacement: str
-    edit_probs: List[Tuple[int, int, float]] = None
+    # Rows of (start, end, prob), see lang_tools.edit_probabilities.
+    edit_probs: Sequence[Tuple[int, int, float]] = field(default=None, compare=False)
 
     def apply(self, expression: str) -> str:
         return expression[: self.start] + self.replacement + expression[self.end :]
@@ -687,9 +1108,10 @@ class Mutation(object):
 
 class AddParents(Visitor):
     def __default__(self, tree):
-        for subtree in tree.children:
+        for index, subtree in enumerate(tree.children):
             if isinstance(subtree, Tree):
                 subtree.parent = tree
+                subtree.parent_index = index
 
 
 class CountPrimitives(Visitor):
@@ -715,9 +1137,13 @@ def random_mutation(
     selection_max_primitives: int = 2,
     replacement_max_primitives: int = 2,
     max_attempts_difference: int = 100,
+    tree: Tree = None,
 ) -> Mutation:
-    tree = grammar.parse(expression)
-    AddParents().visit(tree)
+    """`tree` can be passed to reuse a parse with parents already added."""
+
+    if tree is None:
+        tree = grammar.parse(expression)
+        AddParents().visit(tree)
 
     candidates = nodes_with_max_primitives(
         tree, grammar.primitives, selection_max_primitives
@@ -735,7 +1161,10 @@ def random_mutation(
         if not candidates:
             return None
 
-        candidate = random.choice(candidates)
+        # Candidates are removed by position, list.remove would compare trees
+        # with lark's recursive Tree.__eq__.
+        candidate_index = random.randrange(len(candidates))
+        candidate = candidates[candidate_index]
 
         if not hasattr(candidate, "parent"):
             # We have the root, sample a new expression.
@@ -744,19 +1173,15 @@ def random_mutation(
             sub_expression = expression[start:end]
             start_symbol = grammar.start_symbol
         else:
-            parent = candidate.parent
             start = candidate.meta.start_pos
             end = candidate.meta.end_pos
 
             sub_expression = expression[start:end]
-            self_child_index = parent.children.index(candidate)
-
-            matched = grammar.tree_matcher.match_tree(parent, parent.data)
-            rule_name = matched.children[self_child_index].data
+            rule_name = grammar.child_rule_name(candidate)
             options = grammar.nonterminals[rule_name]
 
             if len(options) <= 1:
-                candidates.remove(candidate)
+                candidates.pop(candidate_index)
                 continue
 
             start_symbol = grammar.names_to_symbols[rule_name]
@@ -774,13 +1199,81 @@ def random_mutation(
                 break
 
             if attempts > max_attempts_difference:
-                candidates.remove(candidate)
+                candidates.pop(candidate_index)
                 break
 
         mutation = Mutation(start, end, replacement_expression)
         return mutation
 
 
+class BloomFilter(object):
+    """Fixed-size set membership filter with no false negatives.
+
+    Memory is bounded by `capacity` and `error_rate` up front: once more than
+    `capacity` items are added the false positive rate degrades, but the
+    filter never grows.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 1e-3):
+        assert capacity > 0, "capacity must be positive"
+        assert 0 < error_rate < 1, "error_rate must be in (0, 1)"
+
+        num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self._num_bits = max(8, num_bits)
+        self._num_hashes = max(1, round(self._num_bits / capacity * math.log(2)))
+        self._bits = bytearray((self._num_bits + 7) // 8)
+
+    @property
+    def num_bits(self) -> int:
+        return self._num_bits
+
+    @property
+    def num_hashes(self) -> int:
+        return self._num_hashes
+
+    def _bit_positions(self, item: str):
+        # Kirsch-Mitzenmacher double hashing from a single 128 bit digest.
+        digest = hashlib.blake2b(item.encode("utf8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self._num_bits for i in range(self._num_hashes)]
+
+    def add(self, item: str) -> bool:
+        """Adds `item`, returning whether it was (probably) already present."""
+
+        present = True
+        for position in self._bit_positions(item):
+            byte, mask = position >> 3, 1 << (position & 7)
+            if not self._bits[byte] & mask:
+                present = False
+                self._bits[byte] |= mask
+        return present
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._bit_positions(item)
+        )
+
+
+def deduplicate_expressions(
+    expressions: Iterable[str],
+    canonicalize: Callable[[str], str],
+    capacity: int = 10_000_000,
+    error_rate: float = 1e-3,
+) -> Iterator[str]:
+    """Lazily yields expressions whose canonical form has not been seen yet.
+
+    A small fraction (about `error_rate`) of unique expressions is dropped as a
+    false positive; duplicates are never yielded.
+    """
+
+    seen = BloomFilter(capacity, error_rate)
+    for expression in expressions:
+        if not seen.add(canonicalize(expression)):
+            yield expression
+
+
 env = CSG2DA()
 sampler = ConstrainedRandomSampler(env.grammar)
 
@@ -805,3 +1298,7 @@ def get_mutated(expr):
 
 def parse_expression(expr):
     return env.grammar.parse(expr)
+
+
+def canonicalize_expression(expr):
+    return env.canonicalize(expr)
@@ -0,0 +1,713 @@
+"""NumPy-backed tooling for lang.py.
+
+lang.js loads lang.py into Pyodide on its own, so code that needs numpy lives
+here and the web demo never downloads it.
+"""
+
+import dataclasses
+import functools
+import itertools
+import math
+import os
+import random
+from dataclasses import dataclass
+from typing import Callable, Iterable, List, Tuple
+
+import numpy as np
+from lark import Token, Tree
+from lark.grammar import NonTerminal, Terminal
+from lark.parsers.lalr_analysis import Shift
+
+from lang import (
+    AddParents,
+    ConstrainedRandomSampler,
+    CSG2DACompiler,
+    Grammar,
+    GrammarSampler,
+    Mutation,
+    env,
+    nodes_with_max_primitives,
+    random_mutation,
+    sampler,
+)
+
+EDIT_PROBS_DTYPE = np.dtype(
+    [("start", np.int64), ("end", np.int64), ("prob", np.float64)]
+)
+
+
+def edit_probabilities(
+    expression: str,
+    grammar: Grammar,
+    selection_max_primitives: int = 2,
+    tree: Tree = None,
+) -> np.ndarray:
+    """Probability that random_mutation selects each (start, end) span.
+
+    Returns one row per span that can be selected, sorted by span. The mass
+    missing from the total is the probability of random_mutation returning
+    None. `tree` can be passed to reuse a parse with parents already added.
+    """
+
+    if tree is None:
+        tree = grammar.parse(expression)
+        AddParents().visit(tree)
+
+    candidates = nodes_with_max_primitives(
+        tree, grammar.primitives, selection_max_primitives
+    )
+
+    starts = np.empty(len(candidates), dtype=np.int64)
+    ends = np.empty(len(candidates), dtype=np.int64)
+    counts = np.empty(len(candidates), dtype=np.int64)
+    valid = np.empty(len(candidates), dtype=bool)
+
+    for i, candidate in enumerate(candidates):
+        counts[i] = candidate.primitive_count
+        if not hasattr(candidate, "parent"):
+            starts[i], ends[i], valid[i] = 0, len(expression), True
+            continue
+
+        starts[i] = candidate.meta.start_pos
+        ends[i] = candidate.meta.end_pos
+        rule_name = grammar.child_rule_name(candidate)
+        valid[i] = len(grammar.nonterminals[rule_name]) > 1
+
+    # A primitive count is picked uniformly, then a node uniformly among the
+    # selectable nodes with that count.
+    unique_counts, count_index = np.unique(counts, return_inverse=True)
+    valid_per_count = np.bincount(
+        count_index, weights=valid, minlength=len(unique_counts)
+    )
+    probs = 1.0 / (len(unique_counts) * valid_per_count[count_index[valid]])
+
+    # Nodes such as `s` and its only child share a span, merge them.
+    width = len(expression) + 1
+    spans, span_index = np.unique(
+        starts[valid] * width + ends[valid], return_inverse=True
+    )
+
+    rv = np.empty(len(spans), dtype=EDIT_PROBS_DTYPE)
+    rv["start"], rv["end"] = np.divmod(spans, width)
+    rv["prob"] = np.bincount(span_index, weights=probs, minlength=len(spans))
+    return rv
+
+
+def random_mutation_with_edit_probs(
+    expression: str,
+    grammar: Grammar,
+    sampler: ConstrainedRandomSampler,
+    selection_max_primitives: int = 2,
+    replacement_max_primitives: int = 2,
+    max_attempts_difference: int = 100,
+) -> Mutation:
+    """random_mutation with `Mutation.edit_probs` set by edit_probabilities."""
+
+    tree = grammar.parse(expression)
+    AddParents().visit(tree)
+
+    edit_probs = edit_probabilities(
+        expression, grammar, selection_max_primitives, tree=tree
+    )
+    mutation = random_mutation(
+        expression,
+        grammar,
+        sampler,
+        selection_max_primitives,
+        replacement_max_primitives,
+        max_attempts_difference,
+        tree=tree,
+    )
+    if mutation is None:
+        return None
+    return dataclasses.replace(mutation, edit_probs=edit_probs)
+
+
+class _ParserStateNode(object):
+    __slots__ = ("state", "parent", "transitions", "mask")
+
+    def __init__(self, state: int, parent: "_ParserStateNode"):
+        self.state = state
+        self.parent = parent
+        self.transitions = {}
+        self.mask = None
+
+
+class GrammarConstraint(object):
+    """Incremental LALR recognizer for grammar-constrained decoding.
+
+    Tokens are indices into `Grammar.vocabulary`. A parser state is an interned
+    LALR stack node, and every node caches the state each token leads to, so
+    the states of all decoded prefixes form a trie and advancing a cached
+    prefix by one token is a dictionary lookup.
+    """
+
+    def __init__(self, grammar: Grammar):
+        self._grammar = grammar
+
+        start = grammar.lark_parser.options.start[0]
+        parse_table = grammar.parse_table
+        self._parse_table_states = parse_table.states
+        self._end_state = parse_table.end_states[start]
+
+        self._token_types = [
+            grammar.rev_vocabulary_map[token] for token in grammar.vocabulary
+        ]
+        self._nodes = {}
+        self._initial_state = self._node(parse_table.start_states[start], None)
+
+    @property
+    def grammar(self) -> Grammar:
+        return self._grammar
+
+    @property
+    def initial_state(self) -> _ParserStateNode:
+        return self._initial_state
+
+    def _node(self, state: int, parent: _ParserStateNode) -> _ParserStateNode:
+        key = (state, parent)
+        node = self._nodes.get(key)
+        if node is None:
+            node = self._nodes[key] = _ParserStateNode(state, parent)
+        return node
+
+    def _feed(self, node: _ParserStateNode, token_type: str, is_end: bool = False):
+        # States pushed by reductions are kept in `pushed` on top of `node`
+        # and only interned once the token is known to be accepted.
+        pushed = []
+        while True:
+            state = pushed[-1] if pushed else node.state
+            action = self._parse_table_states[state].get(token_type)
+            if action is None:
+                return None
+
+            action, arg = action
+            if action is Shift:
+                for state in pushed:
+                    node = self._node(state, node)
+                return self._node(arg, node)
+
+            for _ in range(len(arg.expansion)):
+                if pushed:
+                    pushed.pop()
+                else:
+                    node = node.parent
+
+            state = pushed[-1] if pushed else node.state
+            goto = self._parse_table_states[state][arg.origin.name][1]
+            if is_end and goto == self._end_state:
+                return node
+            pushed.append(goto)
+
+    def _transition(self, state: _ParserStateNode, token: int):
+        if token not in state.transitions:
+            state.transitions[token] = self._feed(state, self._token_types[token])
+        return state.transitions[token]
+
+    def advance(self, state: _ParserStateNode, token: int) -> _ParserStateNode:
+        next_state = self._transition(state, token)
+        if next_state is None:
+            raise ValueError(
+                f"Token {self._grammar.vocabulary[token]!r} is not allowed here"
+            )
+        return next_state
+
+    def state_for_prefix(self, tokens: Iterable[int]) -> _ParserStateNode:
+        state = self._initial_state
+        for token in tokens:
+            state = self.advance(state, token)
+        return state
+
+    def mask(self, state: _ParserStateNode) -> np.ndarray:
+        """Boolean mask over `Grammar.vocabulary` of the allowed next tokens."""
+
+        if state.mask is None:
+            state.mask = np.array(
+                [
+                    self._transition(state, token) is not None
+                    for token in range(len(self._token_types))
+                ],
+                dtype=bool,
+            )
+            state.mask.flags.writeable = False
+        return state.mask
+
+    def batch_mask(self, states: List[_ParserStateNode]) -> np.ndarray:
+        return np.stack([self.mask(state) for state in states])
+
+    def is_complete(self, state: _ParserStateNode) -> bool:
+        """Whether the tokens leading to `state` form a whole expression."""
+
+        return self._feed(state, "$END", is_end=True) is not None
+
+
+@dataclass(frozen=True, eq=False)
+class Derivation(object):
+    """A derivation as pre-order arrays over its nonterminal nodes.
+
+    `productions[i]` is the production id expanding node i and the subtree
+    rooted at node i spans nodes `i` to `i + extents[i]`. Terminals are implied
+    by the productions and only materialized when rendering.
+    """
+
+    productions: np.ndarray
+    extents: np.ndarray
+
+    @classmethod
+    def from_productions(cls, grammar: Grammar, productions) -> "Derivation":
+        productions = np.asarray(productions, dtype=np.int64)
+        arity = grammar.production_arity
+
+        # Walking backwards, the children of a node are already on the stack
+        # with its first child on top.
+        extents = np.empty(len(productions), dtype=np.int64)
+        stack = []
+        for i in range(len(productions) - 1, -1, -1):
+            extent = 1
+            for _ in range(arity[productions[i]]):
+                if not stack:
+                    raise ValueError("Productions do not form a derivation")
+                extent += stack.pop()
+            extents[i] = extent
+            stack.append(extent)
+
+        if len(stack) != 1:
+            raise ValueError("Productions do not form a derivation")
+
+        return cls(productions, extents)
+
+    def __len__(self) -> int:
+        return len(self.productions)
+
+    def symbol(self, grammar: Grammar, index: int = 0):
+        return grammar.productions[self.productions[index]][0]
+
+    def subtree(self, index: int) -> "Derivation":
+        end = index + self.extents[index]
+        return Derivation(self.productions[index:end], self.extents[index:end])
+
+    def splice(self, index: int, replacement: "Derivation") -> "Derivation":
+        """Replaces the subtree rooted at node `index` with `replacement`."""
+
+        end = index + self.extents[index]
+        positions = np.arange(index)
+        ancestors = positions + self.extents[:index] >= end
+
+        extents_before = self.extents[:index].copy()
+        extents_before[ancestors] += len(replacement) - self.extents[index]
+
+        return Derivation(
+            np.concatenate(
+                [
+                    self.productions[:index],
+                    replacement.productions,
+                    self.productions[end:],
+                ]
+            ),
+            np.concatenate([extents_before, replacement.extents, self.extents[end:]]),
+        )
+
+    def primitive_counts(self, grammar: Grammar) -> np.ndarray:
+        """Number of primitives in the subtree rooted at every node."""
+
+        is_primitive = np.array(
+            [symbol.name in grammar.primitives for symbol, _ in grammar.productions],
+            dtype=np.int64,
+        )[self.productions]
+        cumulative = np.concatenate([[0], np.cumsum(is_primitive)])
+        positions = np.arange(len(self.productions))
+        return cumulative[positions + self.extents] - cumulative[positions]
+
+    def to_string(self, grammar: Grammar) -> str:
+        rv = []
+        next_node = 0
+        stack = [self.symbol(grammar)]
+        while stack:
+            symbol = stack.pop()
+            if isinstance(symbol, Terminal):
+                rv.append(grammar.vocabulary_map[symbol.name])
+                continue
+
+            _, expansion = grammar.productions[self.productions[next_node]]
+            next_node += 1
+            stack.extend(reversed(expansion))
+
+        return "".join(rv)
+
+    def to_tree(self, grammar: Grammar) -> Tree:
+        """Builds the tree `grammar.parse` would return, without parsing."""
+
+        # Walking backwards, each finished node is pushed as the list of
+        # children it contributes to its parent, so inlined rules splice in.
+        stack = []
+        for i in range(len(self.productions) - 1, -1, -1):
+            rule = grammar.production_rules[self.productions[i]]
+
+            children = []
+            for x in rule.expansion:
+                if isinstance(x, NonTerminal):
+                    children.extend(stack.pop())
+                elif not x.filter_out:
+                    children.append(Token(x.name, grammar.vocabulary_map[x.name]))
+
+            if rule.origin.name.startswith("_"):
+                stack.append(children)
+            elif rule.options.expand1 and len(children) == 1:
+                stack.append(children)
+            else:
+                stack.append([Tree(rule.alias or rule.origin.name, children)])
+
+        (tree,) = stack[0]
+        return tree
+
+
+@dataclass(frozen=True, eq=False)
+class DerivationMutation(object):
+    index: int
+    replacement: Derivation
+
+    def apply(self, derivation: Derivation) -> Derivation:
+        return derivation.splice(self.index, self.replacement)
+
+
+def random_derivation_mutation(
+    derivation: Derivation,
+    grammar: Grammar,
+    sampler: GrammarSampler,
+    selection_max_primitives: int = 2,
+    replacement_max_primitives: int = 2,
+    max_attempts_difference: int = 100,
+) -> DerivationMutation:
+    """random_mutation over a Derivation, selecting from the same nodes.
+
+    `sampler` must accept `return_productions=True`.
+    """
+
+    primitive_counts = derivation.primitive_counts(grammar)
+    candidates = np.flatnonzero(primitive_counts <= selection_max_primitives)
+
+    candidate_primitive_count = random.choice(
+        list(set(primitive_counts[candidates].tolist()))
+    )
+    candidates = candidates[primitive_counts[candidates] == candidate_primitive_count]
+    candidates = candidates.tolist()
+
+    while True:
+        if not candidates:
+            return None
+
+        candidate = random.choice(candidates)
+
+        # A node's production already names the rule it expands, so unlike
+        # random_mutation no tree matching is needed.
+        start_symbol = derivation.symbol(grammar, candidate)
+        if candidate != 0 and len(grammar.nonterminals[start_symbol.name]) <= 1:
+            candidates.remove(candidate)
+            continue
+
+        sub_derivation = derivation.subtree(candidate)
+
+        attempts = 0
+        while True:
+            replacement = Derivation.from_productions(
+                grammar,
+                sampler.sample(
+                    start_symbol,
+                    min_primitives=0,
+                    max_primitives=replacement_max_primitives,
+                    return_productions=True,
+                ),
+            )
+            attempts += 1
+
+            if not np.array_equal(replacement.productions, sub_derivation.productions):
+                break
+
+            if attempts > max_attempts_difference:
+                candidates.remove(candidate)
+                break
+
+        return DerivationMutation(candidate, replacement)
+
+
+def sample_derivation():
+    return Derivation.from_productions(
+        env.grammar,
+        sampler.sample(env.grammar.start_symbol, 4, 4, return_productions=True),
+    )
+
+
+def derivation_to_ops(derivation):
+    rv = env.compiler.compile(derivation.to_tree(env.grammar))
+
+    if isinstance(rv, str):
+        return [rv]
+    return rv
+
+
+def get_mutated_derivation(derivation):
+    m = random_derivation_mutation(derivation, env.grammar, sampler)
+    return m.apply(derivation)
+
+
+def derivation_to_expression(derivation):
+    return derivation.to_string(env.grammar)
+
+
+class CSG2DARasterCompiler(CSG2DACompiler):
+    """Compiles a CSG2DA tree to a boolean mask of the 32x32 canvas.
+
+    Paths are combined left to right with union and difference, as
+    ExpressionPanel does with CanvasKit path ops.
+    """
+
+    def __init__(self, resolution: int = 64) -> None:
+        super().__init__()
+        self._resolution = resolution
+
+        # Pixel centres in canvas coordinates.
+        centers = (np.arange(resolution) + 0.5) * (32 / resolution)
+        self._xs, self._ys = np.meshgrid(centers, centers)
+
+    @property
+    def resolution(self) -> int:
+        return self._resolution
+
+    def _rasterize_path(self, path: str) -> np.ndarray:
+        name, *numbers = path.split(" ")
+        numbers = [float(x) for x in numbers]
+
+        if name == "circle":
+            r, x, y = numbers
+            return (self._xs - x) ** 2 + (self._ys - y) ** 2 <= r**2
+
+        # Quads are convex, so a pixel is inside when it is strictly on the
+        # same side of all four edges. The tolerance keeps zero-area quads empty
+        # regardless of rounding in their rotated corners.
+        corners = list(zip(numbers[0::2], numbers[1::2]))
+        sides = [
+            (x1 - x0) * (self._ys - y0) - (y1 - y0) * (self._xs - x0)
+            for (x0, y0), (x1, y1) in zip(corners, corners[1:] + corners[:1])
+        ]
+        return np.all([s > 1e-9 for s in sides], axis=0) | np.all(
+            [s < -1e-9 for s in sides], axis=0
+        )
+
+    def compile(self, expression: Tree) -> np.ndarray:
+        paths_and_ops = self._get_path(expression)
+        if isinstance(paths_and_ops, str):
+            paths_and_ops = [paths_and_ops]
+
+        mask = np.zeros((self._resolution, self._resolution), dtype=bool)
+        union = True
+        for item in paths_and_ops:
+            if item == "+":
+                union = True
+            elif item == "-":
+                union = False
+            elif union:
+                mask |= self._rasterize_path(item)
+            else:
+                mask &= ~self._rasterize_path(item)
+
+        return mask
+
+
+@functools.lru_cache(maxsize=None)
+def _popcount_table():
+    return np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _popcount(words: np.ndarray) -> np.ndarray:
+    # Set bits per row of uint64 words. np.bitwise_count is numpy >= 2 only.
+    if hasattr(np, "bitwise_count"):
+        counts = np.bitwise_count(words)
+    else:
+        counts = _popcount_table()[words.view(np.uint8)]
+
+    # Coarse signatures are a single word, skip the row reduction.
+    if counts.shape[1] == 1:
+        return counts[:, 0]
+    return counts.sum(axis=1, dtype=np.int32)
+
+
+def _mask_signatures(masks: np.ndarray, size: int) -> np.ndarray:
+    # Block-average (batch, resolution, resolution) masks down to size x size,
+    # threshold at half coverage and pack the cells into uint64 words.
+    batch, resolution, _ = masks.shape
+    block = resolution // size
+    assert block * size == resolution, "resolution must be a multiple of size"
+    assert size * size % 64 == 0, "size * size must be a multiple of 64"
+
+    cells = masks.reshape(batch, size, block, size, block).mean(axis=(2, 4)) >= 0.5
+    packed = np.packbits(cells.reshape(batch, size * size), axis=1)
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def _signature_iou(signatures: np.ndarray, query: np.ndarray) -> np.ndarray:
+    intersection = _popcount(signatures & query)
+    union = _popcount(signatures | query)
+    # Two empty masks match exactly.
+    return (intersection + (union == 0)) / np.maximum(union, 1)
+
+
+class ShapeIndex(object):
+    """Nearest neighbour index from rendered masks to the programs drawing them.
+
+    Every program is stored as a coarse and a fine downsampled bit signature
+    in memory-mapped arrays. A query scores all coarse signatures by IoU and
+    reranks the best candidates with the fine ones.
+
+    Directory layout: `coarse.npy` and `fine.npy` hold the signatures,
+    `expressions.txt` the programs and `offsets.npy` their byte offsets.
+    """
+
+    def __init__(self, directory: str):
+        self._directory = directory
+        self._coarse = np.load(os.path.join(directory, "coarse.npy"), mmap_mode="r")
+        self._fine = np.load(os.path.join(directory, "fine.npy"), mmap_mode="r")
+        self._offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+        # Empty files cannot be memory-mapped, as when every expression is empty.
+        expressions_path = os.path.join(directory, "expressions.txt")
+        if os.path.getsize(expressions_path):
+            self._expressions = np.memmap(expressions_path, dtype=np.uint8, mode="r")
+        else:
+            self._expressions = np.zeros(0, dtype=np.uint8)
+
+        self._coarse_size = math.isqrt(self._coarse.shape[1] * 64)
+        self._fine_size = math.isqrt(self._fine.shape[1] * 64)
+
+    @classmethod
+    def build(
+        cls,
+        directory: str,
+        expressions: Iterable[str],
+        num_expressions: int,
+        rasterize: Callable[[str], np.ndarray],
+        coarse_size: int = 8,
+        fine_size: int = 16,
+        chunk_size: int = 4096,
+    ) -> "ShapeIndex":
+        """Writes an index of the first `num_expressions` of `expressions`.
+
+        `expressions` is consumed lazily in chunks, e.g. a generator of
+        `sample()` calls passed through deduplicate_expressions.
+        """
+
+        if num_expressions < 0:
+            raise ValueError("num_expressions must not be negative")
+
+        os.makedirs(directory, exist_ok=True)
+        coarse = np.lib.format.open_memmap(
+            os.path.join(directory, "coarse.npy"),
+            mode="w+",
+            dtype=np.uint64,
+            shape=(num_expressions, coarse_size * coarse_size // 64),
+        )
+        fine = np.lib.format.open_memmap(
+            os.path.join(directory, "fine.npy"),
+            mode="w+",
+            dtype=np.uint64,
+            shape=(num_expressions, fine_size * fine_size // 64),
+        )
+        offsets = np.lib.format.open_memmap(
+            os.path.join(directory, "offsets.npy"),
+            mode="w+",
+            dtype=np.int64,
+            shape=(num_expressions + 1,),
+        )
+        offsets[0] = 0
+
+        expressions = iter(expressions)
+        count = 0
+        with open(os.path.join(directory, "expressions.txt"), "wb") as f:
+            while count < num_expressions:
+                chunk = list(
+                    itertools.islice(
+                        expressions, min(chunk_size, num_expressions - count)
+                    )
+                )
+                if not chunk:
+                    raise ValueError(
+                        f"Expected {num_expressions} expressions, got {count}"
+                    )
+
+                masks = np.stack([rasterize(expression) for expression in chunk])
+                end = count + len(chunk)
+                coarse[count:end] = _mask_signatures(masks, coarse_size)
+                fine[count:end] = _mask_signatures(masks, fine_size)
+
+                encoded = [expression.encode("utf8") for expression in chunk]
+                f.write(b"".join(encoded))
+                offsets[count + 1 : end + 1] = offsets[count] + np.cumsum(
+                    [len(e) for e in encoded]
+                )
+                count = end
+
+        for array in (coarse, fine, offsets):
+            array.flush()
+        del coarse, fine, offsets
+
+        return cls(directory)
+
+    def __len__(self) -> int:
+        return len(self._coarse)
+
+    def expression(self, index: int) -> str:
+        start, end = self._offsets[index], self._offsets[index + 1]
+        return self._expressions[start:end].tobytes().decode("utf8")
+
+    def query(
+        self,
+        mask: np.ndarray,
+        k: int = 10,
+        num_candidates: int = None,
+        chunk_size: int = 1 << 20,
+    ) -> List[Tuple[str, float]]:
+        """The `k` programs whose masks best match `mask`, with approximate IoU.
+
+        `mask` is a square boolean image whose side is a multiple of the fine
+        signature size, such as CSG2DARasterCompiler output.
+        """
+
+        if num_candidates is None:
+            num_candidates = max(64, 16 * k)
+        num_candidates = min(num_candidates, len(self))
+        k = min(k, num_candidates)
+        if k == 0:
+            return []
+
+        masks = np.asarray(mask, dtype=bool)[None]
+        coarse_query = _mask_signatures(masks, self._coarse_size)
+        fine_query = _mask_signatures(masks, self._fine_size)
+
+        # Scan the coarse signatures in chunks to bound memory, keeping the
+        # running best candidates.
+        best_indices = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0)
+        for start in range(0, len(self), chunk_size):
+            scores = _signature_iou(
+                np.asarray(self._coarse[start : start + chunk_size]), coarse_query
+            )
+            if len(scores) > num_candidates:
+                keep = np.argpartition(-scores, num_candidates - 1)[:num_candidates]
+            else:
+                keep = np.arange(len(scores))
+            best_indices = np.concatenate([best_indices, keep + start])
+            best_scores = np.concatenate([best_scores, scores[keep]])
+            if len(best_scores) > num_candidates:
+                keep = np.argpartition(-best_scores, num_candidates - 1)
+                keep = keep[:num_candidates]
+                best_indices, best_scores = best_indices[keep], best_scores[keep]
+
+        best_indices = np.sort(best_indices)
+        scores = _signature_iou(np.asarray(self._fine[best_indices]), fine_query)
+        order = np.argsort(-scores, kind="stable")[:k]
+        return [(self.expression(best_indices[i]), float(scores[i])) for i in order]
+
+
+raster_compiler = CSG2DARasterCompiler()
+
+
+def expression_to_mask(expr):
+    return raster_compiler.compile(env.grammar.parse(expr))
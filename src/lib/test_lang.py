@@ -0,0 +1,380 @@
+import collections
+import os
+import random
+import subprocess
+import sys
+import tracemalloc
+
+import lark
+import numpy as np
+import pytest
+
+import lang
+import lang_tools
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "(+ (Circle 2 8 8) (- (Circle 5 8 8) (Circle 3 8 8)))",
+        "(- (Circle 1 2 3) (+ (Quad 8 F D F M) (Circle 3 0 6)))",
+        "(+ (- (Circle 1 2 3) (Circle 1 1 1)) (+ (Quad 8 F D F M) (Circle 3 0 6)))",
+        "(Quad 7 9 0 5 L)",
+    ],
+)
+def test_canonical_form_draws_the_same_mask(expression):
+    canonical = lang.canonicalize_expression(expression)
+    assert np.array_equal(
+        lang_tools.expression_to_mask(expression),
+        lang_tools.expression_to_mask(canonical),
+    )
+
+
+def test_canonical_form_of_samples_draws_the_same_mask():
+    random.seed(0)
+    for _ in range(300):
+        expression = lang.sample()
+        canonical = lang.canonicalize_expression(expression)
+        assert np.array_equal(
+            lang_tools.expression_to_mask(expression),
+            lang_tools.expression_to_mask(canonical),
+        )
+
+
+def test_canonical_form_orders_unions():
+    assert lang.canonicalize_expression(
+        "(+ (Quad 8 F D F M) (Circle 3 0 6))"
+    ) == lang.canonicalize_expression("(+ (Circle 3 0 6) (Quad 8 F F D K))")
+
+
+def test_canonical_form_of_deep_union_is_linear_in_memory():
+    expression = "(Circle 1 2 3)"
+    for _ in range(20000):
+        expression = f"(+ (Circle 1 2 3) {expression})"
+    tree = lang.env.grammar.parse(expression)
+
+    tracemalloc.start()
+    try:
+        canonical = lang.CSG2DACanonicalizer().canonicalize(tree)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert len(canonical) == len(expression)
+    assert peak < 64 * len(expression)
+
+
+def test_bloom_filter_has_no_false_negatives():
+    random.seed(0)
+    items = [str(random.getrandbits(64)) for _ in range(2000)]
+    bloom = lang.BloomFilter(capacity=1000, error_rate=1e-2)
+
+    for item in items[:1000]:
+        bloom.add(item)
+    assert all(item in bloom for item in items[:1000])
+    assert all(bloom.add(item) for item in items[:1000])
+    assert sum(item in bloom for item in items[1000:]) < 30
+
+
+@pytest.mark.parametrize(
+    "capacity, error_rate, num_bits, num_hashes",
+    [(1000, 1e-3, 14378, 10), (1000, 1e-2, 9586, 7), (1, 0.5, 8, 6)],
+)
+def test_bloom_filter_sizing(capacity, error_rate, num_bits, num_hashes):
+    # m = ceil(-n ln(p) / ln(2)^2), at least 8, and k = round(m / n ln(2)).
+    bloom = lang.BloomFilter(capacity, error_rate)
+    assert bloom.num_bits == num_bits
+    assert bloom.num_hashes == num_hashes
+
+
+def test_deduplicate_expressions():
+    expressions = [
+        "(+ (Circle 1 2 3) (Quad 8 F D F M))",
+        "(+ (Quad 8 F D F M) (Circle 1 2 3))",
+        "(+ (Circle 1 2 3) (Quad 8 F F D K))",
+        "(- (Circle 1 2 3) (Quad 8 F D F M))",
+        "(- (Quad 8 F D F M) (Circle 1 2 3))",
+        "(- (Quad 8 F D F I) (Circle 1 2 3))",
+    ]
+    assert list(
+        lang.deduplicate_expressions(
+            iter(expressions), lang.canonicalize_expression, capacity=100
+        )
+    ) == [expressions[0], expressions[3], expressions[4]]
+
+
+def test_derivation_counts():
+    grammar = lang.env.grammar
+    num_primitive_shapes = 16**3 + 16**4 * 8
+    assert grammar.derivation_counts(grammar.start_symbol, 2) == [
+        0,
+        num_primitive_shapes,
+        2 * num_primitive_shapes**2,
+    ]
+
+
+def test_uniform_size_sampler_is_uniform():
+    grammar = lang.Grammar(
+        r"""
+        s: binop | a | b
+        a: "a"
+        b: "b"
+        binop: "(" s s ")"
+        """,
+        start="s",
+        primitives=["a", "b"],
+    )
+    sampler = lang.UniformSizeSampler(grammar)
+
+    random.seed(0)
+    counts = collections.Counter(
+        sampler.sample_with_primitives(grammar.start_symbol, 3) for _ in range(16000)
+    )
+    assert len(counts) == grammar.derivation_counts(grammar.start_symbol, 3)[3] == 16
+    assert all(800 < count < 1200 for count in counts.values())
+
+
+def _deep_chain(depth):
+    expression = "(Circle 1 2 3)"
+    for _ in range(depth):
+        expression = f"(+ (Circle 1 2 3) {expression})"
+    return expression
+
+
+def test_edit_probabilities_on_deep_expression():
+    expression = _deep_chain(10000)
+    random.seed(0)
+    mutation = lang_tools.random_mutation_with_edit_probs(
+        expression, lang.env.grammar, lang.sampler
+    )
+    assert mutation.edit_probs["prob"].sum() == pytest.approx(1.0)
+
+
+def test_edit_probabilities_match_random_mutation():
+    grammar = lang.env.grammar
+    expression = "(- (+ (Circle 1 2 3) (Quad 8 F D F M)) (Circle 3 0 6))"
+    random.seed(0)
+    mutation = lang_tools.random_mutation_with_edit_probs(
+        expression, grammar, lang.sampler
+    )
+    probs = {(start, end): prob for start, end, prob in mutation.edit_probs.tolist()}
+
+    # A primitive count of 0, 1 or 2 is picked uniformly, then one of the 13
+    # tokens, 3 primitives or the single union with that count.
+    assert probs[(3, 38)] == pytest.approx(1 / 3)
+    assert collections.Counter(round(prob * 117) for prob in probs.values()) == {
+        39: 1,
+        13: 3,
+        3: 13,
+    }
+
+    draws = 5000
+    counts = collections.Counter()
+    for _ in range(draws):
+        mutation = lang.random_mutation(expression, grammar, lang.sampler)
+        counts[(mutation.start, mutation.end)] += 1
+    assert counts.keys() == probs.keys()
+    assert all(abs(counts[span] / draws - prob) < 0.02 for span, prob in probs.items())
+
+
+def test_random_mutation_on_deep_expressions():
+    grammar = lang.env.grammar
+    left_nested = "(Circle 1 2 3)"
+    for _ in range(10000):
+        left_nested = f"(- {left_nested} (Quad 1 2 3 4 G))"
+
+    for expression in (_deep_chain(10000), left_nested):
+        random.seed(0)
+        mutation = lang.random_mutation(expression, grammar, lang.sampler)
+        grammar.parse(mutation.apply(expression))
+
+
+def test_tree_walks_on_large_expressions():
+    grammar = lang.env.grammar
+    random.seed(0)
+    expression = lang.sampler.sample(grammar.start_symbol, 10000, 10000)
+    assert len(lang.expression_to_ops(expression)) == 2 * 10000 - 1
+    lang.canonicalize_expression(expression)
+
+    expression = _deep_chain(10000)
+    assert len(lang.expression_to_ops(expression)) == 2 * 10001 - 1
+    lang.canonicalize_expression(expression)
+
+
+def test_naive_random_sampler():
+    grammar = lang.env.grammar
+    random.seed(0)
+    expression = lang.NaiveRandomSampler(grammar).sample(
+        grammar.names_to_symbols["quad"]
+    )
+    grammar.parse(expression)
+
+
+def test_web_demo_does_not_import_numpy():
+    # lang.js loads lang.py into Pyodide without numpy.
+    script = (
+        "import sys, lang\n"
+        "expression = lang.sample()\n"
+        "lang.expression_to_ops(expression)\n"
+        "lang.get_mutated(expression)\n"
+        "assert 'numpy' not in sys.modules\n"
+    )
+    subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=os.path.dirname(os.path.abspath(lang.__file__)),
+        check=True,
+    )
+
+
+def _vocabulary_tokens(grammar, expression):
+    return [
+        grammar.vocabulary.index(t.value) for t in grammar.lark_parser.lex(expression)
+    ]
+
+
+def test_grammar_constraint_matches_lark_interactive_parser():
+    grammar = lang.env.grammar
+    constraint = lang_tools.GrammarConstraint(grammar)
+    token_types = [grammar.rev_vocabulary_map[t] for t in grammar.vocabulary]
+
+    random.seed(0)
+    for _ in range(30):
+        expression = lang.sample()
+        interactive = grammar.lark_parser.parse_interactive()
+        state = constraint.initial_state
+        for token in _vocabulary_tokens(grammar, expression):
+            accepts = interactive.accepts()
+            allowed = {token_types[i] for i in np.flatnonzero(constraint.mask(state))}
+            assert allowed == accepts - {"$END"}
+            assert constraint.is_complete(state) == ("$END" in accepts)
+
+            interactive.feed_token(
+                lark.Token(token_types[token], grammar.vocabulary[token])
+            )
+            state = constraint.advance(state, token)
+
+        assert interactive.accepts() == {"$END"}
+        assert constraint.is_complete(state)
+        assert not constraint.mask(state).any()
+
+
+def test_grammar_constraint_states():
+    grammar = lang.env.grammar
+    constraint = lang_tools.GrammarConstraint(grammar)
+    expression = "(+ (Circle 1 2 3) (Quad 8 F D F M))"
+    tokens = _vocabulary_tokens(grammar, expression)
+
+    assert not constraint.is_complete(constraint.initial_state)
+    assert not constraint.is_complete(constraint.state_for_prefix(tokens[:-1]))
+    assert constraint.is_complete(constraint.state_for_prefix(tokens))
+    assert constraint.state_for_prefix(tokens) is constraint.state_for_prefix(tokens)
+
+    with pytest.raises(ValueError):
+        constraint.advance(constraint.initial_state, grammar.vocabulary.index(")"))
+
+    states = [constraint.state_for_prefix(tokens[:i]) for i in range(len(tokens) + 1)]
+    masks = constraint.batch_mask(states)
+    assert masks.shape == (len(tokens) + 1, len(grammar.vocabulary))
+    assert masks.dtype == bool
+    assert all(masks[i, token] for i, token in enumerate(tokens))
+
+
+def test_derivations_match_parsed_expressions():
+    grammar = lang.env.grammar
+    random.seed(0)
+    for _ in range(50):
+        derivation = lang_tools.sample_derivation()
+        expression = derivation.to_string(grammar)
+        assert derivation.to_tree(grammar) == grammar.parse(expression)
+        assert lang_tools.derivation_to_ops(derivation) == lang.expression_to_ops(
+            expression
+        )
+
+
+def test_derivation_splice_extents():
+    grammar = lang.env.grammar
+    random.seed(0)
+    for _ in range(50):
+        derivation = lang_tools.sample_derivation()
+        mutation = lang_tools.random_derivation_mutation(
+            derivation, grammar, lang.sampler
+        )
+        mutated = mutation.apply(derivation)
+        rebuilt = lang_tools.Derivation.from_productions(grammar, mutated.productions)
+        assert np.array_equal(mutated.extents, rebuilt.extents)
+        grammar.parse(mutated.to_string(grammar))
+
+
+def _derivation_spans(grammar, derivation):
+    # (start, end) in the rendered string of every node, in pre-order.
+    starts = []
+    position = 0
+    stack = [derivation.symbol(grammar)]
+    while stack:
+        symbol = stack.pop()
+        if isinstance(symbol, lark.grammar.Terminal):
+            position += len(grammar.vocabulary_map[symbol.name])
+            continue
+
+        _, expansion = grammar.productions[derivation.productions[len(starts)]]
+        starts.append(position)
+        stack.extend(reversed(expansion))
+
+    return [
+        (start, start + len(derivation.subtree(i).to_string(grammar)))
+        for i, start in enumerate(starts)
+    ]
+
+
+def test_derivation_mutation_matches_edit_probabilities():
+    grammar = lang.env.grammar
+    random.seed(0)
+    derivation = lang_tools.sample_derivation()
+    expression = derivation.to_string(grammar)
+    probs = {
+        (start, end): prob
+        for start, end, prob in lang_tools.edit_probabilities(
+            expression, grammar
+        ).tolist()
+    }
+
+    spans = _derivation_spans(grammar, derivation)
+    draws = 5000
+    counts = collections.Counter()
+    for _ in range(draws):
+        mutation = lang_tools.random_derivation_mutation(
+            derivation, grammar, lang.sampler
+        )
+        counts[spans[mutation.index]] += 1
+    assert counts.keys() == probs.keys()
+    assert all(abs(counts[span] / draws - prob) < 0.02 for span, prob in probs.items())
+
+
+def test_shape_index_returns_indexed_program(tmp_path):
+    random.seed(0)
+    expressions = [lang.sample() for _ in range(200)]
+    index = lang_tools.ShapeIndex.build(
+        str(tmp_path),
+        iter(expressions),
+        len(expressions),
+        lang_tools.expression_to_mask,
+    )
+
+    (expression, iou), *_ = index.query(
+        lang_tools.expression_to_mask(expressions[7]), k=3
+    )
+    assert iou == 1.0
+    assert np.array_equal(
+        lang_tools.expression_to_mask(expression),
+        lang_tools.expression_to_mask(expressions[7]),
+    )
+
+
+@pytest.mark.parametrize("expressions", [[], ["", ""]])
+def test_shape_index_without_expression_bytes(tmp_path, expressions):
+    mask = lang_tools.expression_to_mask("(Circle 1 2 3)")
+    index = lang_tools.ShapeIndex.build(
+        str(tmp_path), iter(expressions), len(expressions), lambda _: mask
+    )
+    assert len(index) == len(expressions)
+    assert [e for e, _ in index.query(mask)] == expressions